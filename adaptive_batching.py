@@ -0,0 +1,162 @@
+import os
+import time
+import pandas
+from sqlalchemy.engine import Engine
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Default memory ceiling for the whole process
+MEMORY_LIMIT_MB = 1024
+# A chunk is copied a few times while it is cleaned and inserted, keep room for that
+MEMORY_SAFETY_FACTOR = 3
+
+
+def current_rss():
+    # Resident set size of the current process in bytes, None when there is no way to read it
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class AdaptiveBatchSize:
+    # Hill climbing on rows/sec: keep moving the batch size while throughput beats the best size seen so far,
+    # go back to the best size when it gets worse, never go over the memory ceiling
+
+    def __init__(self, name, initial_size=1000, min_size=100, max_size=1000000,
+                 memory_limit_mb=MEMORY_LIMIT_MB, step=2.0, tolerance=0.05):
+        self.name = name
+        self.size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.memory_limit = memory_limit_mb * 1024 * 1024
+        self.step = step
+        self.tolerance = tolerance
+        self.direction = 1
+        self.best_size = None
+        self.best_throughput = None
+        # Whether the best size was reached by moving towards it, then the other side is known to be slower
+        self.best_from_move = False
+        self.turned = False
+        self.memory_warning_printed = False
+
+    def memory_cap(self, bytes_per_row, rss):
+        # Number of rows that still fits between the current RSS and the ceiling
+        free = self.memory_limit - rss
+        if free <= 0:
+            return self.min_size
+        return int(free // (bytes_per_row * MEMORY_SAFETY_FACTOR))
+
+    def _next_size(self, throughput):
+        if self.best_throughput is None or throughput > self.best_throughput * (1 + self.tolerance):
+            self.best_from_move = self.best_size is not None and self.size != self.best_size
+            self.best_size, self.best_throughput = self.size, throughput
+            self.turned = False
+            if self.direction == 0:
+                self.direction = 1
+            return self.size * self.step ** self.direction, 'throughput improved'
+
+        if self.size == self.best_size:
+            # Measured at the best size again: refresh its throughput and keep probing, or hold if both sides are slower
+            self.best_throughput = throughput
+            return self.size * self.step ** self.direction, 'best size'
+
+        if throughput < self.best_throughput * (1 - self.tolerance):
+            # Moving away from the best size made it slower: go back and try the other side at most once
+            if self.best_from_move or self.turned:
+                self.direction = 0
+            else:
+                self.direction = -1 if self.size > self.best_size else 1
+            self.turned = True
+            return self.best_size, 'back to best size'
+
+        # About as fast as the best size, no reason to move further
+        self.direction = 0
+        return self.size, 'plateau'
+
+    def observe(self, rows, seconds, bytes_per_row=None, rss=None):
+        # Feeds back one processed batch and returns the size to use for the next one
+        if rows == 0:
+            return self.size
+
+        throughput = rows / max(seconds, 1e-6)
+        previous = self.size
+        size, reason = self._next_size(throughput)
+
+        if bytes_per_row and rss is None and not self.memory_warning_printed:
+            print(f'{self.name}: current RSS is not available, memory ceiling is disabled')
+            self.memory_warning_printed = True
+        elif bytes_per_row and rss is not None:
+            cap = self.memory_cap(bytes_per_row, rss)
+            if rss >= self.memory_limit:
+                size = self.size / self.step
+                reason = 'memory ceiling reached'
+            elif size > cap:
+                size = cap
+                reason = 'memory ceiling'
+
+        self.size = int(min(max(size, self.min_size), self.max_size))
+
+        rss_info = f', rss {rss / 1024 / 1024:.0f} MB' if rss is not None else ''
+        print(f'{self.name}: {rows} rows in {seconds:.2f} sec ({throughput:.0f} rows/sec{rss_info}), '
+              f'size {previous} -> {self.size} ({reason})')
+        return self.size
+
+
+def bytes_per_row(df: pandas.DataFrame):
+    if len(df) == 0:
+        return 0
+    return df.memory_usage(index=False, deep=True).sum() / len(df)
+
+
+def read_csv_adaptive(path, controller: AdaptiveBatchSize, max_rows=None, **kwargs):
+    # Yields chunks of a csv, asking the controller for the size of every next chunk.
+    # The caller reports each chunk back through controller.observe once it has been processed
+    rows_read = 0
+    with pandas.read_csv(path, chunksize=controller.size, **kwargs) as reader:
+        while max_rows is None or rows_read < max_rows:
+            size = controller.size if max_rows is None else min(controller.size, max_rows - rows_read)
+            try:
+                chunk = reader.get_chunk(size)
+            except StopIteration:
+                return
+            rows_read += len(chunk)
+            yield chunk
+
+
+def to_sql_adaptive(df: pandas.DataFrame, name, con, schema=None, if_exists='append', controller=None,
+                    memory_limit_mb=MEMORY_LIMIT_MB, **kwargs):
+    # Inserts the dataframe in batches whose size is tuned by the controller.
+    # All batches share one transaction, so a failed batch does not leave a replaced table half filled
+    if isinstance(con, Engine):
+        with con.begin() as connection:
+            return to_sql_adaptive(df, name, connection, schema, if_exists, controller, memory_limit_mb, **kwargs)
+
+    if controller is None:
+        controller = AdaptiveBatchSize(f'insert {name}', memory_limit_mb=memory_limit_mb)
+    if len(df) == 0:
+        df.to_sql(name, con, schema=schema, if_exists=if_exists, index=False, **kwargs)
+        return 0
+    row_width = bytes_per_row(df)
+
+    position = 0
+    while position < len(df):
+        batch = df.iloc[position:position + controller.size]
+        start = time.time()
+        batch.to_sql(name, con, schema=schema, if_exists=if_exists, index=False, chunksize=len(batch), **kwargs)
+
+        # A short remainder batch is slower per row and would mislead the controller
+        if len(batch) == controller.size:
+            controller.observe(len(batch), time.time() - start, row_width, current_rss())
+
+        # Only the first batch may replace the table
+        if_exists = 'append'
+        position += len(batch)
+
+    return len(df)
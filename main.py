@@ -4,9 +4,13 @@ import sqlalchemy
 from sqlalchemy import text
 import time
 
+from adaptive_batching import MEMORY_LIMIT_MB, to_sql_adaptive
+from spatial_index import build_location_index
+
 pd.options.display.width = 0
 
 source_array = ["data/hosts.csv", "data/listings.csv", "data/calendar.csv"]
+location_index_path = "data/location_index.npz"
 
 SERVER = "localhost:1433"
 DATABASE = "Airbnb"
@@ -33,7 +37,7 @@ def clear_listings(listings: pd.DataFrame):
     listings['extra_people'] = listings['extra_people'].replace('[\$,]', '', regex=True).astype(float)
 
 
-def load_to_stage():
+def load_to_stage(memory_limit_mb=MEMORY_LIMIT_MB):
     dataframes = extract_data()
 
     hosts = dataframes.get("hosts")
@@ -46,18 +50,16 @@ def load_to_stage():
 
     start = time.time()
 
-    hosts.to_sql(name="HostsStage", con=engine, if_exists='replace',
-                 index=False,
-                 schema='airbnb_stage'
-                 )
+    # Insert batch sizes adapt to row width, so wide listings and narrow calendar rows need no tuning
+    to_sql_adaptive(hosts, "HostsStage", engine, if_exists='replace',
+                    schema='airbnb_stage', memory_limit_mb=memory_limit_mb
+                    )
 
-    listings.to_sql(name="ListingStage", con=engine, if_exists='replace',
-                    index=False,
-                    schema='airbnb_stage'
+    to_sql_adaptive(listings, "ListingStage", engine, if_exists='replace',
+                    schema='airbnb_stage', memory_limit_mb=memory_limit_mb
                     )
-    calendar.to_sql(name="CalendarStage", con=engine, if_exists='replace',
-                    index=False,
-                    schema='airbnb_stage'
+    to_sql_adaptive(calendar, "CalendarStage", engine, if_exists='replace',
+                    schema='airbnb_stage', memory_limit_mb=memory_limit_mb
                     )
 
     print(f'Loading to stage area: {time.time() - start} sec')
@@ -107,7 +109,7 @@ def transform_listings():
     load_dim_hosts()
     load_dim_prices()
     load_dim_location()
-
+    build_location_index(engine, location_index_path)
 
 
 def transform_and_load_dim_apartment():
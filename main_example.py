@@ -8,6 +8,10 @@ import time
 import sqlalchemy
 from sqlalchemy import create_engine, text
 
+from adaptive_batching import MEMORY_LIMIT_MB, AdaptiveBatchSize, bytes_per_row, current_rss, read_csv_adaptive, \
+    to_sql_adaptive
+from star_aggregates import build_aggregates, invalidate_cache, load_fact_chunk
+
 
 # Press ⌃R to execute it or replace it with your code.
 # Press Double ⇧ to search everywhere for classes, files, tool windows, actions, and settings.
@@ -27,6 +31,111 @@ engine = create_engine(
 # connection = pyodbc.connect("DRIVER={ODBC Driver 18 for SQL Server};Server=localhost;Database=Reestr;UID=SA;PWD=reallyStrongPwd123;TrustServerCertificate=yes;")
 
 
+# Column types of the registry in the staging area
+staging_columns = {
+    'PERSON': sqlalchemy.VARCHAR(length=1),
+    'REG_ADDR_KOATUU': sqlalchemy.VARCHAR(length=30),
+    'OPER_CODE': sqlalchemy.VARCHAR(length=3),
+    'OPER_NAME': sqlalchemy.NVARCHAR(length=200),
+    'D_REG': sqlalchemy.DATE,
+    'DEP_CODE': sqlalchemy.INTEGER,
+    'DEP': sqlalchemy.NVARCHAR(length=300),
+    'BRAND': sqlalchemy.NVARCHAR(length=300),
+    'MODEL': sqlalchemy.NVARCHAR(length=300),
+    'VIN': sqlalchemy.NVARCHAR(length=50),
+    'MAKE_YEAR': sqlalchemy.INTEGER,
+    'COLOR': sqlalchemy.NVARCHAR(length=50),
+    'KIND': sqlalchemy.NVARCHAR(length=50),
+    'BODY': sqlalchemy.NVARCHAR(length=50),
+    'PURPOSE': sqlalchemy.NVARCHAR(length=50),
+    'FUEL': sqlalchemy.NVARCHAR(length=50),
+    'CAPACITY': sqlalchemy.FLOAT,
+    'OWN_WEIGHT': sqlalchemy.FLOAT,
+    'TOTAL_WEIGHT': sqlalchemy.FLOAT,
+    'N_REG_NEW': sqlalchemy.NVARCHAR(length=16)
+}
+
+# Star schema tables with their column types
+star_schema_tables_with_columns = {
+    'DimCarInfo': {
+        'VIN': sqlalchemy.NVARCHAR(length=50),
+        'CAPACITY': sqlalchemy.FLOAT,
+        'OWN_WEIGHT': sqlalchemy.FLOAT,
+        'TOTAL_WEIGHT': sqlalchemy.FLOAT,
+        'MAKE_YEAR': sqlalchemy.INTEGER
+    },
+    'DimCarBrand': {
+        'BRAND': sqlalchemy.NVARCHAR(length=300),
+        'MODEL': sqlalchemy.NVARCHAR(length=300)
+    },
+    'DimCarColor': {
+        'COLOR': sqlalchemy.NVARCHAR(length=50)
+    },
+    'DimCarKind': {
+        'KIND': sqlalchemy.NVARCHAR(length=50)
+    },
+    'DimCarBody': {
+        'BODY': sqlalchemy.NVARCHAR(length=50)
+    },
+    'DimCarPurpose': {
+        'PURPOSE': sqlalchemy.NVARCHAR(length=50)
+    },
+    'DimCarFuel': {
+        'FUEL': sqlalchemy.NVARCHAR(length=50)
+    },
+    'DimOperation': {
+        'OPER_CODE': sqlalchemy.VARCHAR(length=3),
+        'OPER_NAME': sqlalchemy.NVARCHAR(length=200)
+    },
+    'DimCustomer': {
+        'PERSON': sqlalchemy.VARCHAR(length=1),
+        'REG_ADDR_KOATUU': sqlalchemy.VARCHAR(length=30)
+    },
+    'DimDepartment': {
+        'DEP_CODE': sqlalchemy.INTEGER,
+        'DEP': sqlalchemy.NVARCHAR(length=300)
+    },
+    'DimDate': {
+        'DAY': sqlalchemy.INTEGER,
+        'MONTH': sqlalchemy.INTEGER,
+        'YEAR': sqlalchemy.INTEGER
+    },
+    'MeasureCarProperties': {
+        'CAR_INFO_ID': sqlalchemy.INTEGER,
+        'CAR_BRAND_ID': sqlalchemy.INTEGER,
+        'CAR_COLOR_ID': sqlalchemy.INTEGER,
+        'CAR_KIND_ID': sqlalchemy.INTEGER,
+        'CAR_BODY_ID': sqlalchemy.INTEGER,
+        'CAR_PURPOSE_ID': sqlalchemy.INTEGER,
+        'CAR_FUEL_ID': sqlalchemy.INTEGER,
+        'OPERATION_ID': sqlalchemy.INTEGER,
+        'CUSTOMER_ID': sqlalchemy.INTEGER,
+        'DEP_ID': sqlalchemy.INTEGER,
+        'DATE_ID': sqlalchemy.INTEGER,
+        'N_REG_NEW': sqlalchemy.NVARCHAR(length=16)
+    }
+}
+
+# Maps staged registry rows to the dimension ids of the fact table, {0} is the staged table
+fact_rows_query = '''
+SELECT B.ID AS CAR_INFO_ID, C.ID AS CAR_BRAND_ID, 
+    D.ID AS CAR_COLOR_ID, E.ID AS CAR_KIND_ID, F.ID AS CAR_BODY_ID, 
+    G.ID AS CAR_PURPOSE_ID, H.ID AS CAR_FUEL_ID, I.ID AS OPERATION_ID, J.ID AS CUSTOMER_ID, K.ID AS DEP_ID, L.ID AS DATE_ID, A.N_REG_NEW
+    FROM {0} AS A 
+        INNER JOIN star.DimCustomer AS J ON (A.PERSON = J.PERSON OR (A.PERSON IS NULL AND J.PERSON IS NULL)) AND (A.REG_ADDR_KOATUU = J.REG_ADDR_KOATUU OR (A.REG_ADDR_KOATUU IS NULL AND J.REG_ADDR_KOATUU IS NULL))
+        INNER JOIN star.DimCarInfo AS B ON (A.VIN = B.VIN OR (A.VIN IS NULL AND B.VIN IS NULL)) AND (A.CAPACITY = B.CAPACITY OR (A.CAPACITY IS NULL AND B.CAPACITY IS NULL)) AND (A.OWN_WEIGHT = B.OWN_WEIGHT OR (A.OWN_WEIGHT IS NULL AND B.OWN_WEIGHT IS NULL)) AND (A.TOTAL_WEIGHT = B.TOTAL_WEIGHT OR (A.TOTAL_WEIGHT IS NULL AND B.TOTAL_WEIGHT IS NULL)) AND (A.MAKE_YEAR = B.MAKE_YEAR OR (A.MAKE_YEAR IS NULL AND B.MAKE_YEAR IS NULL))
+        INNER JOIN star.DimCarBrand AS C ON (A.BRAND = C.BRAND OR (A.BRAND IS NULL AND C.BRAND IS NULL)) AND (A.MODEL = C.MODEL OR (A.MODEL IS NULL AND C.MODEL IS NULL))
+        INNER JOIN star.DimCarColor AS D ON (A.COLOR = D.COLOR OR (A.COLOR IS NULL AND D.COLOR IS NULL))
+        INNER JOIN star.DimCarKind AS E ON (A.KIND = E.KIND OR (A.KIND IS NULL AND E.KIND IS NULL))
+        INNER JOIN star.DimCarBody AS F ON (A.BODY = F.BODY OR (A.BODY IS NULL AND F.BODY IS NULL))
+        INNER JOIN star.DimCarPurpose AS G ON (A.PURPOSE = G.PURPOSE OR (A.PURPOSE IS NULL AND G.PURPOSE IS NULL))
+        INNER JOIN star.DimCarFuel AS H ON (A.FUEL = H.FUEL OR (A.FUEL IS NULL AND H.FUEL IS NULL))
+        INNER JOIN star.DimOperation AS I ON (A.OPER_NAME = I.OPER_NAME OR (A.OPER_NAME IS NULL AND I.OPER_NAME IS NULL)) AND (A.OPER_CODE = I.OPER_CODE OR (A.OPER_CODE IS NULL AND I.OPER_CODE IS NULL))
+        INNER JOIN star.DimDepartment AS K ON (A.DEP = K.DEP OR (A.DEP IS NULL AND K.DEP IS NULL)) AND (A.DEP_CODE = K.DEP_CODE OR (A.DEP_CODE IS NULL AND K.DEP_CODE IS NULL))
+        INNER JOIN star.DimDate AS L ON YEAR(A.D_REG) = L.YEAR AND MONTH(A.D_REG) = L.MONTH AND DAY(A.D_REG) = L.DAY
+'''
+
+
 def time_decorator(function):
     def inner_decorator(*args, **kwargs):
         start_time = time.time()
@@ -59,7 +168,7 @@ def validate_engine():
 
 
 # Consolidating data in the manually-created staging area
-def staging_area_load(number_of_rows):
+def staging_area_load(number_of_rows, incremental=False, memory_limit_mb=MEMORY_LIMIT_MB):
 
     validate_engine()
 
@@ -68,13 +177,15 @@ def staging_area_load(number_of_rows):
 
         # Dynamically generating csv name
         csv_name = link.split('/')[::-1][0].replace(".zip", ".csv")
-        chunk_size = number_of_rows // 10
         iteration_number = 0
 
-        for chunk in pandas.read_csv(csv_name, sep=";", low_memory=False, chunksize=chunk_size):
+        # Chunk and insert batch sizes are tuned on the fly, number_of_rows caps the rows read per dataset
+        read_controller = AdaptiveBatchSize(f'read {csv_name}', initial_size=10000, memory_limit_mb=memory_limit_mb)
+        insert_controller = AdaptiveBatchSize(f'insert {csv_name}', memory_limit_mb=memory_limit_mb)
+        fact_controller = AdaptiveBatchSize(f'insert facts of {csv_name}', memory_limit_mb=memory_limit_mb)
+        parse_start = time.time()
 
-            if iteration_number == 10:
-                break
+        for chunk in read_csv_adaptive(csv_name, read_controller, max_rows=number_of_rows, sep=";", low_memory=False):
 
             iteration_number += 1
 
@@ -94,95 +205,27 @@ def staging_area_load(number_of_rows):
             chunk['D_REG'] = pandas.to_datetime(chunk['D_REG'])
             chunk['D_REG'] = chunk['D_REG'].dt.strftime('%Y-%m-%d')
 
+            parse_time = time.time() - parse_start
+
             # Inserting data
             print(f'Insert chunk number {iteration_number}')
             start = time.time()
-            chunk.to_sql('reestr', engine, if_exists='append', index=False, schema='stg', chunksize=chunk_size, dtype={
-                'PERSON': sqlalchemy.VARCHAR(length=1),
-                'REG_ADDR_KOATUU': sqlalchemy.VARCHAR(length=30),
-                'OPER_CODE': sqlalchemy.VARCHAR(length=3),
-                'OPER_NAME': sqlalchemy.NVARCHAR(length=200),
-                'D_REG': sqlalchemy.DATE,
-                'DEP_CODE': sqlalchemy.INTEGER,
-                'DEP': sqlalchemy.NVARCHAR(length=300),
-                'BRAND': sqlalchemy.NVARCHAR(length=300),
-                'MODEL': sqlalchemy.NVARCHAR(length=300),
-                'VIN': sqlalchemy.NVARCHAR(length=50),
-                'MAKE_YEAR': sqlalchemy.INTEGER,
-                'COLOR': sqlalchemy.NVARCHAR(length=50),
-                'KIND': sqlalchemy.NVARCHAR(length=50),
-                'BODY': sqlalchemy.NVARCHAR(length=50),
-                'PURPOSE': sqlalchemy.NVARCHAR(length=50),
-                'FUEL': sqlalchemy.NVARCHAR(length=50),
-                'CAPACITY': sqlalchemy.FLOAT,
-                'OWN_WEIGHT': sqlalchemy.FLOAT,
-                'TOTAL_WEIGHT': sqlalchemy.FLOAT,
-                'N_REG_NEW': sqlalchemy.NVARCHAR(length=16)
-            })
-            print("Total time per chunk: " + str(time.time() - start))
+            if incremental:
+                load_registry_chunk(chunk, insert_controller, fact_controller)
+            else:
+                to_sql_adaptive(chunk, 'reestr', engine, schema='stg', if_exists='append', controller=insert_controller,
+                                dtype=staging_columns)
+            insert_time = time.time() - start
+            print("Total time per chunk: " + str(insert_time))
+
+            # The last, shorter chunk of a dataset is not representative for the controller
+            if len(chunk) == read_controller.size:
+                read_controller.observe(len(chunk), parse_time + insert_time, bytes_per_row(chunk), current_rss())
+            parse_start = time.time()
 
 # Transforming data
 @time_decorator
-def transform():
-    star_schema_tables_with_columns = {
-                                          'DimCarInfo': {
-                                              'VIN': sqlalchemy.NVARCHAR(length=50),
-                                              'CAPACITY': sqlalchemy.FLOAT,
-                                              'OWN_WEIGHT': sqlalchemy.FLOAT,
-                                              'TOTAL_WEIGHT': sqlalchemy.FLOAT,
-                                              'MAKE_YEAR': sqlalchemy.INTEGER
-                                          },
-                                          'DimCarBrand': {
-                                              'BRAND': sqlalchemy.NVARCHAR(length=300),
-                                              'MODEL': sqlalchemy.NVARCHAR(length=300)
-                                          },
-                                          'DimCarColor': {
-                                              'COLOR': sqlalchemy.NVARCHAR(length=50)
-                                          },
-                                          'DimCarKind': {
-                                              'KIND': sqlalchemy.NVARCHAR(length=50)
-                                          },
-                                          'DimCarBody': {
-                                              'BODY': sqlalchemy.NVARCHAR(length=50)
-                                          },
-                                          'DimCarPurpose': {
-                                              'PURPOSE': sqlalchemy.NVARCHAR(length=50)
-                                          },
-                                          'DimCarFuel': {
-                                              'FUEL': sqlalchemy.NVARCHAR(length=50)
-                                          },
-                                          'DimOperation': {
-                                              'OPER_CODE': sqlalchemy.VARCHAR(length=3),
-                                              'OPER_NAME': sqlalchemy.NVARCHAR(length=200)
-                                          },
-                                          'DimCustomer': {
-                                              'PERSON': sqlalchemy.VARCHAR(length=1),
-                                              'REG_ADDR_KOATUU': sqlalchemy.VARCHAR(length=30)
-                                          },
-                                          'DimDepartment': {
-                                              'DEP_CODE': sqlalchemy.INTEGER,
-                                              'DEP': sqlalchemy.NVARCHAR(length=300)
-                                          },
-                                          'DimDate': {
-                                              'DAY': sqlalchemy.INTEGER,
-                                              'MONTH': sqlalchemy.INTEGER,
-                                              'YEAR': sqlalchemy.INTEGER
-                                          },
-                                          'MeasureCarProperties': {
-                                              'CAR_INFO_ID': sqlalchemy.INTEGER,
-                                              'CAR_BRAND_ID': sqlalchemy.INTEGER,
-                                              'CAR_COLOR_ID': sqlalchemy.INTEGER,
-                                              'CAR_KIND_ID': sqlalchemy.INTEGER,
-                                              'CAR_BODY_ID': sqlalchemy.INTEGER,
-                                              'CAR_PURPOSE_ID': sqlalchemy.INTEGER,
-                                              'CAR_FUEL_ID': sqlalchemy.INTEGER,
-                                              'OPERATION_ID': sqlalchemy.INTEGER,
-                                              'CUSTOMER_ID': sqlalchemy.INTEGER,
-                                              'DEP_ID': sqlalchemy.INTEGER,
-                                              'DATE_ID': sqlalchemy.INTEGER,
-                                              'N_REG_NEW': sqlalchemy.NVARCHAR(length=16)
-                                          }
-    }
+def transform(memory_limit_mb=MEMORY_LIMIT_MB):
     star_schema = 'star'
     staging_table = 'reestr'
     staging_schema = 'stg'
@@ -191,39 +234,53 @@ def transform():
             with engine.connect() as connection:
                 query = text('SELECT DISTINCT {0} FROM {1}'.format(', '.join(columns.keys()), staging_schema + '.' + staging_table))
                 df = pandas.read_sql(query, connection)
-                load(df, engine, table, star_schema, columns)
+                load(df, engine, table, star_schema, columns, memory_limit_mb)
         elif table.__contains__('Date'):
             dates = pandas.Series(pandas.date_range('2012-01-01', '2040-12-31', freq='D'))
             dataframe = pandas.DataFrame({'DAY': dates.dt.day, 'MONTH': dates.dt.month, 'YEAR': dates.dt.year})
-            load(dataframe, engine, table, star_schema, columns)
+            load(dataframe, engine, table, star_schema, columns, memory_limit_mb)
         else:
             with engine.connect() as connection:
-                query = text(
-                    '''
-SELECT B.ID AS CAR_INFO_ID, C.ID AS CAR_BRAND_ID, 
-    D.ID AS CAR_COLOR_ID, E.ID AS CAR_KIND_ID, F.ID AS CAR_BODY_ID, 
-    G.ID AS CAR_PURPOSE_ID, H.ID AS CAR_FUEL_ID, I.ID AS OPERATION_ID, J.ID AS CUSTOMER_ID, K.ID AS DEP_ID, L.ID AS DATE_ID, A.N_REG_NEW
-    FROM stg.reestr AS A 
-        INNER JOIN star.DimCustomer AS J ON (A.PERSON = J.PERSON OR (A.PERSON IS NULL AND J.PERSON IS NULL)) AND (A.REG_ADDR_KOATUU = J.REG_ADDR_KOATUU OR (A.REG_ADDR_KOATUU IS NULL AND J.REG_ADDR_KOATUU IS NULL))
-        INNER JOIN star.DimCarInfo AS B ON (A.VIN = B.VIN OR (A.VIN IS NULL AND B.VIN IS NULL)) AND (A.CAPACITY = B.CAPACITY OR (A.CAPACITY IS NULL AND B.CAPACITY IS NULL)) AND (A.OWN_WEIGHT = B.OWN_WEIGHT OR (A.OWN_WEIGHT IS NULL AND B.OWN_WEIGHT IS NULL)) AND (A.TOTAL_WEIGHT = B.TOTAL_WEIGHT OR (A.TOTAL_WEIGHT IS NULL AND B.TOTAL_WEIGHT IS NULL)) AND (A.MAKE_YEAR = B.MAKE_YEAR OR (A.MAKE_YEAR IS NULL AND B.MAKE_YEAR IS NULL))
-        INNER JOIN star.DimCarBrand AS C ON (A.BRAND = C.BRAND OR (A.BRAND IS NULL AND C.BRAND IS NULL)) AND (A.MODEL = C.MODEL OR (A.MODEL IS NULL AND C.MODEL IS NULL))
-        INNER JOIN star.DimCarColor AS D ON (A.COLOR = D.COLOR OR (A.COLOR IS NULL AND D.COLOR IS NULL))
-        INNER JOIN star.DimCarKind AS E ON (A.KIND = E.KIND OR (A.KIND IS NULL AND E.KIND IS NULL))
-        INNER JOIN star.DimCarBody AS F ON (A.BODY = F.BODY OR (A.BODY IS NULL AND F.BODY IS NULL))
-        INNER JOIN star.DimCarPurpose AS G ON (A.PURPOSE = G.PURPOSE OR (A.PURPOSE IS NULL AND G.PURPOSE IS NULL))
-        INNER JOIN star.DimCarFuel AS H ON (A.FUEL = H.FUEL OR (A.FUEL IS NULL AND H.FUEL IS NULL))
-        INNER JOIN star.DimOperation AS I ON (A.OPER_NAME = I.OPER_NAME OR (A.OPER_NAME IS NULL AND I.OPER_NAME IS NULL)) AND (A.OPER_CODE = I.OPER_CODE OR (A.OPER_CODE IS NULL AND I.OPER_CODE IS NULL))
-        INNER JOIN star.DimDepartment AS K ON (A.DEP = K.DEP OR (A.DEP IS NULL AND K.DEP IS NULL)) AND (A.DEP_CODE = K.DEP_CODE OR (A.DEP_CODE IS NULL AND K.DEP_CODE IS NULL))
-        INNER JOIN star.DimDate AS L ON YEAR(A.D_REG) = L.YEAR AND MONTH(A.D_REG) = L.MONTH AND DAY(A.D_REG) = L.DAY
-                        '''
-                    )
+                query = text(fact_rows_query.format(staging_schema + '.' + staging_table))
                 dataframe = pandas.read_sql(query, connection)
-                load(dataframe, engine, table, star_schema, columns)
+                load(dataframe, engine, table, star_schema, columns, memory_limit_mb)
+
+    # Rollups are built once the fact table is loaded, staging_area_load(..., incremental=True) keeps them up to date
+    build_aggregates(engine)
+
+
+# Incremental load of a registry chunk that arrives after the star schema has been built
+def load_registry_chunk(chunk: pandas.DataFrame, insert_controller=None, fact_controller=None):
+    # New dimension members, facts, rollups and the staging area are updated in one transaction,
+    # so the star schema never holds facts that stg.reestr does not have
+    with engine.begin() as connection:
+        to_sql_adaptive(chunk, 'reestr_chunk', connection, schema='stg', if_exists='replace',
+                        controller=insert_controller, dtype=staging_columns)
+
+        # Adding dimension members that appear for the first time in this chunk
+        for table, columns in star_schema_tables_with_columns.items():
+            if table.__contains__('Dim') and not table.__contains__('Date'):
+                column_list = ', '.join(columns.keys())
+                match = ' AND '.join(f'(A.{c} = B.{c} OR (A.{c} IS NULL AND B.{c} IS NULL))' for c in columns)
+                connection.execute(text(f'''
+INSERT INTO star.{table} ({column_list})
+    SELECT DISTINCT {column_list} FROM stg.reestr_chunk AS A
+    WHERE NOT EXISTS (SELECT 1 FROM star.{table} AS B WHERE {match})
+'''))
+        facts = pandas.read_sql(text(fact_rows_query.format('stg.reestr_chunk')), connection)
+
+        load_fact_chunk(engine, facts, star_schema_tables_with_columns['MeasureCarProperties'],
+                        controller=fact_controller, connection=connection)
+        to_sql_adaptive(chunk, 'reestr', connection, schema='stg', if_exists='append', controller=insert_controller,
+                        dtype=staging_columns)
+
+    # Results cached while the transaction was still open could be stale
+    invalidate_cache()
 
 
 # Loading data in star schema
-def load(df: pandas.DataFrame, engine, table: str, schema: str, columns):
-    df.to_sql(table, engine, if_exists='append', index=False, schema=schema, chunksize=1000, dtype=columns)
+def load(df: pandas.DataFrame, engine, table: str, schema: str, columns, memory_limit_mb=MEMORY_LIMIT_MB):
+    to_sql_adaptive(df, table, engine, schema=schema, if_exists='append', memory_limit_mb=memory_limit_mb, dtype=columns)
 
 def print_hi(name):
     # Use a breakpoint in the code line below to debug your script.
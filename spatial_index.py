@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+# Size of a grid cell in degrees (~1.1 km in latitude)
+CELL_SIZE = 0.01
+EARTH_RADIUS_KM = 6371.0
+
+# Offsets keep cell coordinates positive so they can be packed into a single int64
+LAT_OFFSET = 90.0
+LON_OFFSET = 180.0
+LON_CELLS_FACTOR = 1 << 32
+
+
+def cell_keys(latitude, longitude, cell_size=CELL_SIZE):
+    # Packs the (row, column) of the grid cell into a single int64 key
+    rows = np.floor((np.asarray(latitude, dtype=np.float64) + LAT_OFFSET) / cell_size).astype(np.int64)
+    cols = np.floor((np.asarray(longitude, dtype=np.float64) + LON_OFFSET) / cell_size).astype(np.int64)
+    return rows * LON_CELLS_FACTOR + cols
+
+
+def cell_centers(keys, cell_size=CELL_SIZE):
+    keys = np.asarray(keys, dtype=np.int64)
+    rows = keys // LON_CELLS_FACTOR
+    cols = keys % LON_CELLS_FACTOR
+    return (rows + 0.5) * cell_size - LAT_OFFSET, (cols + 0.5) * cell_size - LON_OFFSET
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def build_index(locations: pd.DataFrame, cell_size=CELL_SIZE):
+    # Expects 'id', 'latitude', 'longitude' and optionally 'price' columns
+    locations = locations.dropna(subset=['latitude', 'longitude'])
+
+    keys = cell_keys(locations['latitude'].to_numpy(), locations['longitude'].to_numpy(), cell_size)
+    order = np.argsort(keys, kind='stable')
+
+    if 'price' in locations.columns:
+        price = locations['price'].to_numpy(dtype=np.float64)[order]
+    else:
+        price = np.full(len(order), np.nan)
+
+    keys = keys[order]
+    cells, cell_start, cell_count = np.unique(keys, return_index=True, return_counts=True)
+
+    return {
+        'cell_size': np.float64(cell_size),
+        'id': locations['id'].to_numpy(dtype=np.int64)[order],
+        'latitude': locations['latitude'].to_numpy(dtype=np.float64)[order],
+        'longitude': locations['longitude'].to_numpy(dtype=np.float64)[order],
+        'price': price,
+        'cell_key': keys,
+        'cells': cells,
+        'cell_start': cell_start.astype(np.int64),
+        'cell_count': cell_count.astype(np.int64)
+    }
+
+
+def save_index(index, path):
+    np.savez_compressed(path, **index)
+
+
+def load_index(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def _longitude_ranges(min_lon, max_lon):
+    # Splits a longitude span at the antimeridian into ranges inside [-180, 180]
+    if max_lon - min_lon >= 360:
+        return [(-180.0, 180.0)]
+    if min_lon < -180:
+        min_lon, max_lon = min_lon + 360, max_lon + 360
+    elif min_lon > 180:
+        min_lon, max_lon = min_lon - 360, max_lon - 360
+    if max_lon <= 180:
+        return [(min_lon, max_lon)]
+    return [(min_lon, 180.0), (-180.0, max_lon - 360)]
+
+
+def _candidate_positions(index, min_lat, max_lat, min_lon, max_lon):
+    # Positions (in the sorted arrays) of all listings whose cell intersects the box,
+    # the box has to be inside [-90, 90] x [-180, 180]
+    cell_size = float(index['cell_size'])
+    min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+    row_from, col_from = divmod(int(cell_keys(min_lat, min_lon, cell_size)), LON_CELLS_FACTOR)
+    row_to, col_to = divmod(int(cell_keys(max_lat, max_lon, cell_size)), LON_CELLS_FACTOR)
+
+    # Cells are sorted by row first, so the row range is a contiguous slice
+    cells = index['cells']
+    lo = np.searchsorted(cells, row_from * LON_CELLS_FACTOR, side='left')
+    hi = np.searchsorted(cells, (row_to + 1) * LON_CELLS_FACTOR, side='left')
+    cols = cells[lo:hi] % LON_CELLS_FACTOR
+    slots = lo + np.flatnonzero((cols >= col_from) & (cols <= col_to))
+    if len(slots) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    starts = index['cell_start'][slots]
+    counts = index['cell_count'][slots]
+    # Expand every [start, start + count) range without a python loop
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+def _box_positions(index, min_lat, max_lat, min_lon, max_lon):
+    # Positions of the listings inside the box, min_lon > max_lon means the box crosses the antimeridian
+    if min_lon > max_lon:
+        max_lon += 360
+    positions = []
+    for range_from, range_to in _longitude_ranges(min_lon, max_lon):
+        candidates = _candidate_positions(index, min_lat, max_lat, range_from, range_to)
+        lat = index['latitude'][candidates]
+        lon = index['longitude'][candidates]
+        mask = (lat >= min_lat) & (lat <= max_lat) & (lon >= range_from) & (lon <= range_to)
+        positions.append(candidates[mask])
+    return np.unique(np.concatenate(positions))
+
+
+def bbox_query(index, min_lat, max_lat, min_lon, max_lon):
+    positions = _box_positions(index, min_lat, max_lat, min_lon, max_lon)
+    return np.sort(index['id'][positions])
+
+
+def radius_query(index, latitude, longitude, radius_km):
+    angle = radius_km / EARTH_RADIUS_KM
+    lat_delta = np.degrees(angle)
+    min_lat, max_lat = latitude - lat_delta, latitude + lat_delta
+
+    # Exact longitudinal half-width of the circle, every longitude when it reaches a pole
+    ratio = np.sin(angle) / np.cos(np.radians(latitude)) if abs(latitude) < 90 else np.inf
+    if min_lat <= -90 or max_lat >= 90 or angle >= np.pi / 2 or ratio >= 1:
+        min_lon, max_lon = -180.0, 180.0
+    else:
+        lon_delta = np.degrees(np.arcsin(ratio))
+        min_lon, max_lon = longitude - lon_delta, longitude + lon_delta
+
+    positions = _box_positions(index, max(min_lat, -90.0), min(max_lat, 90.0), min_lon, max_lon)
+    distance = haversine_km(latitude, longitude, index['latitude'][positions], index['longitude'][positions])
+    mask = distance <= radius_km
+
+    result = pd.DataFrame({'id': index['id'][positions[mask]], 'distance_km': distance[mask]})
+    return result.sort_values('distance_km', ignore_index=True)
+
+
+def cell_aggregates(index):
+    center_lat, center_lon = cell_centers(index['cells'], float(index['cell_size']))
+    prices = pd.Series(index['price']).groupby(index['cell_key'], sort=True).median()
+
+    return pd.DataFrame({
+        'cell_key': index['cells'],
+        'center_latitude': center_lat,
+        'center_longitude': center_lon,
+        'listing_count': index['cell_count'],
+        'median_price': prices.to_numpy()
+    })
+
+
+def read_locations(engine):
+    # The staged listings carry the real listing id next to its coordinates and price,
+    # the identity ids of DimLocation and DimListingPrice are not guaranteed to line up
+    query = text('''
+        SELECT id, latitude, longitude, price
+        FROM airbnb_stage.ListingStage
+    ''')
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn)
+
+
+def build_location_index(engine, path, cell_size=CELL_SIZE):
+    try:
+        index = build_index(read_locations(engine), cell_size)
+        save_index(index, path)
+
+        # Per-cell aggregates are kept next to DimLocation for area-level price analysis
+        aggregates = cell_aggregates(index)
+        aggregates.to_sql(name="DimLocationCell", con=engine, if_exists='replace', schema='airbnb', index=False)
+
+        return index
+    except Exception as e:
+        print(e)
@@ -0,0 +1,189 @@
+import collections
+import pandas
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from adaptive_batching import to_sql_adaptive
+
+star_schema = 'star'
+fact_table = 'MeasureCarProperties'
+delta_table = 'MeasureCarPropertiesDelta'
+delta_schema = 'stg'
+measure = 'REGISTRATIONS'
+
+# Dimension attribute -> (dimension table, foreign key in the fact table)
+dimension_attributes = {
+    'VIN': ('DimCarInfo', 'CAR_INFO_ID'),
+    'MAKE_YEAR': ('DimCarInfo', 'CAR_INFO_ID'),
+    'BRAND': ('DimCarBrand', 'CAR_BRAND_ID'),
+    'MODEL': ('DimCarBrand', 'CAR_BRAND_ID'),
+    'COLOR': ('DimCarColor', 'CAR_COLOR_ID'),
+    'KIND': ('DimCarKind', 'CAR_KIND_ID'),
+    'BODY': ('DimCarBody', 'CAR_BODY_ID'),
+    'PURPOSE': ('DimCarPurpose', 'CAR_PURPOSE_ID'),
+    'FUEL': ('DimCarFuel', 'CAR_FUEL_ID'),
+    'OPER_CODE': ('DimOperation', 'OPERATION_ID'),
+    'OPER_NAME': ('DimOperation', 'OPERATION_ID'),
+    'PERSON': ('DimCustomer', 'CUSTOMER_ID'),
+    'REG_ADDR_KOATUU': ('DimCustomer', 'CUSTOMER_ID'),
+    'DEP_CODE': ('DimDepartment', 'DEP_ID'),
+    'DEP': ('DimDepartment', 'DEP_ID'),
+    'DAY': ('DimDate', 'DATE_ID'),
+    'MONTH': ('DimDate', 'DATE_ID'),
+    'YEAR': ('DimDate', 'DATE_ID')
+}
+
+# Declared rollups: aggregate table -> dimension attributes it is grouped by
+rollups = {
+    'AggBrandMonth': ['BRAND', 'YEAR', 'MONTH'],
+    'AggFuelMonth': ['FUEL', 'YEAR', 'MONTH'],
+    'AggDepartmentMonth': ['DEP_CODE', 'DEP', 'YEAR', 'MONTH'],
+    'AggBrandFuelDepartmentMonth': ['BRAND', 'FUEL', 'DEP_CODE', 'DEP', 'YEAR', 'MONTH']
+}
+
+query_cache_size = 128
+
+# Row count of every built aggregate, used to pick the smallest covering one
+_aggregate_sizes = {}
+_query_cache = collections.OrderedDict()
+
+
+def _grouping_sql(attributes, source, into=None):
+    # Joins only the dimensions needed for the attributes and counts facts per group
+    if not attributes:
+        return f'''
+SELECT COUNT(*) AS {measure}
+    {"INTO " + into if into else ""}
+    FROM {source} AS A
+'''
+
+    tables = {}
+    for attribute in attributes:
+        table, foreign_key = dimension_attributes[attribute]
+        tables[table] = foreign_key
+
+    aliases = {table: f'D{number}' for number, table in enumerate(tables)}
+    columns = ', '.join(f'{aliases[dimension_attributes[a][0]]}.{a}' for a in attributes)
+    joins = '\n'.join(f'INNER JOIN {star_schema}.{table} AS {aliases[table]} ON {aliases[table]}.ID = A.{foreign_key}'
+                      for table, foreign_key in tables.items())
+
+    return f'''
+SELECT {columns}, COUNT(*) AS {measure}
+    {"INTO " + into if into else ""}
+    FROM {source} AS A
+    {joins}
+    GROUP BY {columns}
+'''
+
+
+def _null_safe_match(attributes, left, right):
+    return ' AND '.join(f'({left}.{a} = {right}.{a} OR ({left}.{a} IS NULL AND {right}.{a} IS NULL))'
+                        for a in attributes)
+
+
+def invalidate_cache():
+    _query_cache.clear()
+
+
+def build_aggregates(engine):
+    # Rebuilds every declared rollup from the full fact table
+    with engine.connect() as connection:
+        for table, attributes in rollups.items():
+            connection.execute(text(f'DROP TABLE IF EXISTS {star_schema}.{table}'))
+            connection.execute(text(_grouping_sql(attributes, f'{star_schema}.{fact_table}',
+                                                  into=f'{star_schema}.{table}')))
+            _aggregate_sizes[table] = connection.execute(
+                text(f'SELECT COUNT(*) FROM {star_schema}.{table}')).scalar()
+        connection.commit()
+
+    invalidate_cache()
+
+
+def load_fact_chunk(engine, chunk: pandas.DataFrame, columns, controller=None, connection=None):
+    # Appends a new chunk of facts and folds its counts into every rollup.
+    # Everything runs in one transaction, so a failed MERGE leaves neither facts nor rollups changed.
+    # A connection with an open transaction can be passed to make the update part of a larger one
+    if connection is None:
+        with engine.begin() as connection:
+            return load_fact_chunk(engine, chunk, columns, controller, connection)
+
+    to_sql_adaptive(chunk, fact_table, connection, schema=star_schema, if_exists='append', controller=controller,
+                    dtype=columns)
+    to_sql_adaptive(chunk, delta_table, connection, schema=delta_schema, if_exists='replace', controller=controller,
+                    dtype=columns)
+
+    for table, attributes in rollups.items():
+        column_list = ', '.join(attributes)
+        delta = _grouping_sql(attributes, f'{delta_schema}.{delta_table}')
+        connection.execute(text(f'''
+MERGE {star_schema}.{table} AS T
+    USING ({delta}) AS S
+    ON {_null_safe_match(attributes, 'T', 'S')}
+    WHEN MATCHED THEN
+        UPDATE SET T.{measure} = T.{measure} + S.{measure}
+    WHEN NOT MATCHED THEN
+        INSERT ({column_list}, {measure}) VALUES ({", ".join("S." + a for a in attributes)}, S.{measure});
+'''))
+        _aggregate_sizes[table] = connection.execute(text(f'SELECT COUNT(*) FROM {star_schema}.{table}')).scalar()
+    connection.execute(text(f'DROP TABLE IF EXISTS {delta_schema}.{delta_table}'))
+
+    invalidate_cache()
+
+
+def _load_aggregate_sizes(engine):
+    with engine.connect() as connection:
+        for table in rollups:
+            try:
+                _aggregate_sizes[table] = connection.execute(
+                    text(f'SELECT COUNT(*) FROM {star_schema}.{table}')).scalar()
+            except DBAPIError:
+                # Rollup has not been built yet
+                connection.rollback()
+
+
+def covering_aggregate(attributes):
+    # Smallest built rollup that has every requested attribute, None means the fact table has to be used
+    candidates = [table for table, grouped in rollups.items()
+                  if table in _aggregate_sizes and set(attributes) <= set(grouped)]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda table: _aggregate_sizes[table])
+
+
+def query_registrations(engine, group_by, filters=None):
+    # Number of registrations per group, e.g. query_registrations(engine, ['BRAND', 'MONTH'], {'YEAR': 2021})
+    filters = filters or {}
+    key = (tuple(group_by), tuple(sorted(filters.items())))
+    if key in _query_cache:
+        _query_cache.move_to_end(key)
+        return _query_cache[key].copy()
+
+    if not _aggregate_sizes:
+        _load_aggregate_sizes(engine)
+
+    attributes = list(dict.fromkeys(list(group_by) + list(filters)))
+    table = covering_aggregate(attributes)
+    if table is None:
+        source = f'({_grouping_sql(attributes, f"{star_schema}.{fact_table}")})'
+    else:
+        source = f'{star_schema}.{table}'
+
+    # NULL dimension members have their own rows in the rollups, they can only be matched with IS NULL
+    conditions = ' AND '.join(f'{attribute} IS NULL' if value is None else f'{attribute} = :p{number}'
+                              for number, (attribute, value) in enumerate(filters.items()))
+    columns = ', '.join(group_by)
+    query = text(f'''
+SELECT {columns + ", " if columns else ""}SUM({measure}) AS {measure}
+    FROM {source} AS A
+    {"WHERE " + conditions if conditions else ""}
+    {"GROUP BY " + columns if columns else ""}
+''')
+    parameters = {f'p{number}': value for number, value in enumerate(filters.values()) if value is not None}
+
+    with engine.connect() as connection:
+        result = pandas.read_sql(query, connection, params=parameters)
+
+    _query_cache[key] = result
+    if len(_query_cache) > query_cache_size:
+        _query_cache.popitem(last=False)
+    return result.copy()
@@ -0,0 +1,140 @@
+import os
+
+import pandas as pd
+import pytest
+import sqlalchemy
+
+import adaptive_batching
+from adaptive_batching import AdaptiveBatchSize
+
+MB = 1024 * 1024
+
+
+def feed(controller, throughputs, **kwargs):
+    # Feeds batches of the current size that ran at the given rows/sec, returns the sizes chosen
+    sizes = []
+    for throughput in throughputs:
+        sizes.append(controller.observe(controller.size, controller.size / throughput, **kwargs))
+    return sizes
+
+
+def test_grows_while_throughput_improves():
+    controller = AdaptiveBatchSize('test', initial_size=1000)
+    assert feed(controller, [1000, 2000, 4000]) == [2000, 4000, 8000]
+
+
+def test_returns_to_best_size_after_overshoot():
+    controller = AdaptiveBatchSize('test', initial_size=1000)
+    sizes = feed(controller, [100000, 150000, 236000, 92000, 148000, 150000])
+    assert sizes == [2000, 4000, 8000, 4000, 4000, 4000]
+
+
+def test_tries_the_other_side_once_when_first_step_is_slower():
+    controller = AdaptiveBatchSize('test', initial_size=1000)
+    assert feed(controller, [1000, 500, 1000, 800, 1000, 1000]) == [2000, 1000, 500, 1000, 1000, 1000]
+
+
+def test_holds_on_plateau():
+    controller = AdaptiveBatchSize('test', initial_size=1000)
+    assert feed(controller, [1000, 1010, 1000]) == [2000, 2000, 2000]
+
+
+def test_shrinks_on_drop_after_plateau():
+    controller = AdaptiveBatchSize('test', initial_size=1000)
+    assert feed(controller, [1000, 1000, 200, 100]) == [2000, 2000, 1000, 500]
+
+
+def test_keeps_shrinking_while_throughput_improves_downwards():
+    controller = AdaptiveBatchSize('test', initial_size=1000)
+    assert feed(controller, [1000, 1000, 200, 400, 800]) == [2000, 2000, 1000, 500, 250]
+
+
+def test_respects_min_and_max():
+    controller = AdaptiveBatchSize('test', initial_size=1000, max_size=3000)
+    assert feed(controller, [1000, 2000, 4000]) == [2000, 3000, 3000]
+    controller = AdaptiveBatchSize('test', initial_size=200, min_size=100)
+    assert feed(controller, [1000, 500, 1000, 2000]) == [400, 200, 100, 100]
+
+
+def test_memory_cap_limits_growth():
+    controller = AdaptiveBatchSize('test', initial_size=1000, memory_limit_mb=100)
+    # 40 MB free, 1 KB per row and a safety factor of 3 leave room for ~13 thousand rows
+    size = controller.observe(1000, 1.0, bytes_per_row=1024, rss=60 * MB)
+    assert size == 2000
+    controller.size = 10000
+    size = controller.observe(10000, 1.0, bytes_per_row=1024, rss=60 * MB)
+    assert size == (40 * MB) // (1024 * adaptive_batching.MEMORY_SAFETY_FACTOR)
+
+
+def test_shrinks_over_memory_ceiling():
+    controller = AdaptiveBatchSize('test', initial_size=4000, memory_limit_mb=100)
+    assert controller.observe(4000, 1.0, bytes_per_row=1024, rss=120 * MB) == 2000
+
+
+def test_warns_once_when_rss_unavailable(capsys):
+    controller = AdaptiveBatchSize('test', initial_size=1000, memory_limit_mb=1)
+    assert controller.observe(1000, 1.0, bytes_per_row=1024, rss=None) == 2000
+    controller.observe(2000, 1.0, bytes_per_row=1024, rss=None)
+    assert capsys.readouterr().out.count('memory ceiling is disabled') == 1
+
+
+def test_current_rss_without_psutil(monkeypatch):
+    monkeypatch.setattr(adaptive_batching, 'psutil', None)
+    if os.path.exists('/proc/self/statm'):
+        assert adaptive_batching.current_rss() > 0
+
+    def missing(*args, **kwargs):
+        raise OSError
+    monkeypatch.setattr('builtins.open', missing)
+    assert adaptive_batching.current_rss() is None
+
+
+def test_to_sql_adaptive_skips_remainder_batch(monkeypatch):
+    inserted = []
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', lambda self, *args, **kwargs: inserted.append(len(self)))
+    monkeypatch.setattr(adaptive_batching, 'current_rss', lambda: None)
+
+    controller = AdaptiveBatchSize('test', initial_size=100, min_size=10)
+    observed = []
+    original = controller.observe
+    controller.observe = lambda rows, *args: observed.append(rows) or original(rows, *args)
+
+    df = pd.DataFrame({'a': range(750)})
+    assert adaptive_batching.to_sql_adaptive(df, 'table', None, controller=controller) == 750
+    assert sum(inserted) == 750
+    assert inserted == [100, 200, 400, 50]
+    assert observed == [100, 200, 400]
+
+
+def test_to_sql_adaptive_is_one_transaction_on_engine(monkeypatch, tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "test.db"}')
+
+    # pysqlite runs DDL outside of transactions by default, let SQLAlchemy emit BEGIN itself
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @sqlalchemy.event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+    pd.DataFrame({'a': [1, 2, 3]}).to_sql('table', engine, index=False)
+
+    original = pd.DataFrame.to_sql
+    calls = []
+
+    def failing_second_batch(self, *args, **kwargs):
+        calls.append(len(self))
+        if len(calls) == 2:
+            raise RuntimeError('insert failed')
+        return original(self, *args, **kwargs)
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', failing_second_batch)
+
+    controller = AdaptiveBatchSize('test', initial_size=100, min_size=10)
+    with pytest.raises(RuntimeError):
+        adaptive_batching.to_sql_adaptive(pd.DataFrame({'a': range(500)}), 'table', engine, if_exists='replace',
+                                          controller=controller)
+
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', original)
+    with engine.connect() as connection:
+        assert pd.read_sql('SELECT a FROM "table"', connection)['a'].tolist() == [1, 2, 3]
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import spatial_index
+
+
+def random_locations(seed, size, lat_range, lon_range):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'id': np.arange(size) + 1,
+        'latitude': rng.uniform(*lat_range, size),
+        'longitude': rng.uniform(*lon_range, size),
+        'price': rng.uniform(20, 500, size)
+    })
+
+
+def brute_force_bbox(locations, min_lat, max_lat, min_lon, max_lon):
+    lat, lon = locations['latitude'], locations['longitude']
+    if min_lon <= max_lon:
+        lon_mask = (lon >= min_lon) & (lon <= max_lon)
+    else:
+        lon_mask = (lon >= min_lon) | (lon <= max_lon)
+    return np.sort(locations['id'][(lat >= min_lat) & (lat <= max_lat) & lon_mask].to_numpy())
+
+
+def brute_force_radius(locations, latitude, longitude, radius_km):
+    distance = spatial_index.haversine_km(latitude, longitude, locations['latitude'], locations['longitude'])
+    return np.sort(locations['id'][distance <= radius_km].to_numpy())
+
+
+def test_cell_keys_are_ordered_by_row_then_column():
+    keys = spatial_index.cell_keys([47.605, 47.605, 47.615], [-122.335, -122.325, -122.335])
+    assert keys[0] < keys[1] < keys[2]
+    assert keys[0] == spatial_index.cell_keys(47.6051, -122.3349)
+
+
+def test_cell_keys_are_non_negative_at_the_edges():
+    keys = spatial_index.cell_keys([-90.0, 90.0, 0.0], [-180.0, 180.0, 0.0])
+    assert (keys >= 0).all()
+
+
+def test_cell_centers_round_trip():
+    keys = spatial_index.cell_keys([47.6051], [-122.3349])
+    lat, lon = spatial_index.cell_centers(keys)
+    assert spatial_index.cell_keys(lat, lon)[0] == keys[0]
+
+
+@pytest.mark.parametrize('box', [
+    (47.55, 47.65, -122.40, -122.30),
+    (47.0, 48.0, -123.0, -122.0),
+    (10.0, 11.0, 10.0, 11.0)
+])
+def test_bbox_query_matches_brute_force(box):
+    locations = random_locations(1, 5000, (47.5, 47.7), (-122.45, -122.2))
+    index = spatial_index.build_index(locations)
+    np.testing.assert_array_equal(spatial_index.bbox_query(index, *box), brute_force_bbox(locations, *box))
+
+
+def test_bbox_query_across_antimeridian():
+    locations = random_locations(2, 3000, (-20.0, -10.0), (-180.0, 180.0))
+    index = spatial_index.build_index(locations)
+    box = (-18.0, -12.0, 170.0, -170.0)
+    np.testing.assert_array_equal(spatial_index.bbox_query(index, *box), brute_force_bbox(locations, *box))
+
+
+@pytest.mark.parametrize('center, radius_km', [
+    ((47.61, -122.33), 1.0),
+    ((47.61, -122.33), 5.0),
+    ((42.0, -122.33), 500.0)
+])
+def test_radius_query_matches_brute_force(center, radius_km):
+    locations = random_locations(3, 5000, (center[0] - 6, center[0] + 6), (center[1] - 8, center[1] + 8))
+    index = spatial_index.build_index(locations, cell_size=0.05)
+    result = spatial_index.radius_query(index, *center, radius_km)
+    np.testing.assert_array_equal(np.sort(result['id'].to_numpy()), brute_force_radius(locations, *center, radius_km))
+    assert result['distance_km'].is_monotonic_increasing
+
+
+@pytest.mark.parametrize('center, radius_km', [
+    ((0.0, 179.9), 100.0),
+    ((0.0, -179.9), 100.0),
+    ((89.5, 0.0), 200.0)
+])
+def test_radius_query_at_antimeridian_and_poles(center, radius_km):
+    locations = random_locations(4, 20000, (center[0] - 3, min(center[0] + 3, 90.0)), (-180.0, 180.0))
+    index = spatial_index.build_index(locations, cell_size=0.1)
+    result = spatial_index.radius_query(index, *center, radius_km)
+    expected = brute_force_radius(locations, *center, radius_km)
+    assert len(expected) > 0
+    np.testing.assert_array_equal(np.sort(result['id'].to_numpy()), expected)
+
+
+def test_cell_aggregates():
+    locations = pd.DataFrame({
+        'id': [1, 2, 3, 4],
+        'latitude': [47.6051, 47.6052, 47.6053, 47.7051],
+        'longitude': [-122.3349, -122.3348, -122.3347, -122.3349],
+        'price': [100.0, 200.0, 400.0, 50.0]
+    })
+    aggregates = spatial_index.cell_aggregates(spatial_index.build_index(locations))
+    assert aggregates['listing_count'].tolist() == [3, 1]
+    assert aggregates['median_price'].tolist() == [200.0, 50.0]
+
+
+def test_save_and_load_index(tmp_path):
+    locations = random_locations(5, 100, (47.5, 47.7), (-122.45, -122.2))
+    index = spatial_index.build_index(locations)
+    path = tmp_path / 'index.npz'
+    spatial_index.save_index(index, path)
+    loaded = spatial_index.load_index(path)
+    assert loaded.keys() == index.keys()
+    for name in index:
+        np.testing.assert_array_equal(loaded[name], index[name])
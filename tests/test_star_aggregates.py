@@ -0,0 +1,179 @@
+import contextlib
+
+import pandas as pd
+import pytest
+
+import star_aggregates
+
+
+class FakeResult:
+    def scalar(self):
+        return 10
+
+
+class FakeConnection:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, statement, *args, **kwargs):
+        self.statements.append(str(statement))
+        return FakeResult()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeEngine:
+    def __init__(self):
+        self.statements = []
+
+    @contextlib.contextmanager
+    def connect(self):
+        yield FakeConnection(self.statements)
+
+    begin = connect
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    # Every rollup is built, the combined one is the largest
+    monkeypatch.setattr(star_aggregates, '_aggregate_sizes', {
+        'AggBrandMonth': 500,
+        'AggFuelMonth': 100,
+        'AggDepartmentMonth': 300,
+        'AggBrandFuelDepartmentMonth': 5000
+    })
+    monkeypatch.setattr(star_aggregates, '_query_cache', star_aggregates.collections.OrderedDict())
+    return FakeEngine()
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    executed = []
+
+    def read_sql(query, connection, params=None):
+        executed.append((str(query), params))
+        return pd.DataFrame({star_aggregates.measure: [len(executed)]})
+    monkeypatch.setattr(star_aggregates.pandas, 'read_sql', read_sql)
+    return executed
+
+
+def test_covering_aggregate_picks_smallest(engine):
+    assert star_aggregates.covering_aggregate(['FUEL', 'YEAR']) == 'AggFuelMonth'
+    assert star_aggregates.covering_aggregate(['MONTH']) == 'AggFuelMonth'
+    assert star_aggregates.covering_aggregate(['BRAND', 'FUEL']) == 'AggBrandFuelDepartmentMonth'
+
+
+def test_covering_aggregate_without_match(engine):
+    assert star_aggregates.covering_aggregate(['COLOR']) is None
+
+
+def test_covering_aggregate_ignores_rollups_not_built(engine, monkeypatch):
+    monkeypatch.setattr(star_aggregates, '_aggregate_sizes', {'AggBrandFuelDepartmentMonth': 5000})
+    assert star_aggregates.covering_aggregate(['FUEL']) == 'AggBrandFuelDepartmentMonth'
+
+
+def test_grouping_sql_joins_each_dimension_once():
+    sql = star_aggregates._grouping_sql(['DEP_CODE', 'DEP', 'YEAR', 'MONTH'], 'star.MeasureCarProperties')
+    assert sql.count('INNER JOIN star.DimDepartment') == 1
+    assert sql.count('INNER JOIN star.DimDate') == 1
+    assert sql.count('INNER JOIN') == 2
+    assert 'GROUP BY D0.DEP_CODE, D0.DEP, D1.YEAR, D1.MONTH' in sql
+
+
+def test_grouping_sql_without_attributes():
+    sql = star_aggregates._grouping_sql([], 'star.MeasureCarProperties')
+    assert 'SELECT COUNT(*) AS REGISTRATIONS' in sql
+    assert 'GROUP BY' not in sql and 'JOIN' not in sql
+
+
+def test_query_is_routed_to_smallest_rollup(engine, queries):
+    star_aggregates.query_registrations(engine, ['FUEL', 'MONTH'], {'YEAR': 2021})
+    sql, params = queries[0]
+    assert 'FROM star.AggFuelMonth' in sql
+    assert 'YEAR = :p0' in sql
+    assert params == {'p0': 2021}
+
+
+def test_query_falls_back_to_fact_table(engine, queries):
+    star_aggregates.query_registrations(engine, ['COLOR'])
+    assert 'FROM star.MeasureCarProperties' in queries[0][0]
+
+
+def test_query_without_groups_or_filters(engine, queries, monkeypatch):
+    monkeypatch.setattr(star_aggregates, '_aggregate_sizes', {'AggBrandMonth': 1})
+    monkeypatch.setattr(star_aggregates, 'rollups', {'AggBrandMonth': ['BRAND']})
+    star_aggregates.query_registrations(engine, [])
+    assert 'FROM star.AggBrandMonth' in queries[0][0]
+
+    monkeypatch.setattr(star_aggregates, 'rollups', {})
+    star_aggregates.invalidate_cache()
+    star_aggregates.query_registrations(engine, [])
+    sql = queries[1][0]
+    assert 'SELECT ,' not in sql and 'SELECT COUNT(*) AS REGISTRATIONS' in sql
+
+
+def test_none_filter_uses_is_null(engine, queries):
+    star_aggregates.query_registrations(engine, ['MONTH'], {'FUEL': None, 'YEAR': 2021})
+    sql, params = queries[0]
+    assert 'FUEL IS NULL' in sql
+    assert 'YEAR = :p1' in sql
+    assert params == {'p1': 2021}
+
+
+def test_query_cache_hit(engine, queries):
+    first = star_aggregates.query_registrations(engine, ['BRAND'], {'YEAR': 2021})
+    second = star_aggregates.query_registrations(engine, ['BRAND'], {'YEAR': 2021})
+    assert len(queries) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+    # Callers get a copy, changing it does not change the cached result
+    second.loc[0, star_aggregates.measure] = -1
+    assert star_aggregates.query_registrations(engine, ['BRAND'], {'YEAR': 2021}).equals(first)
+
+
+def test_query_cache_evicts_least_recently_used(engine, queries, monkeypatch):
+    monkeypatch.setattr(star_aggregates, 'query_cache_size', 2)
+    star_aggregates.query_registrations(engine, ['BRAND'])
+    star_aggregates.query_registrations(engine, ['FUEL'])
+    star_aggregates.query_registrations(engine, ['BRAND'])
+    star_aggregates.query_registrations(engine, ['DEP'])
+    assert len(queries) == 3
+
+    # FUEL was the least recently used one and has been evicted, BRAND is still cached
+    star_aggregates.query_registrations(engine, ['BRAND'])
+    assert len(queries) == 3
+    star_aggregates.query_registrations(engine, ['FUEL'])
+    assert len(queries) == 4
+
+
+def test_build_aggregates_invalidates_cache(engine, queries):
+    star_aggregates.query_registrations(engine, ['BRAND'])
+    star_aggregates.build_aggregates(engine)
+    assert star_aggregates._aggregate_sizes['AggBrandMonth'] == 10
+    star_aggregates.query_registrations(engine, ['BRAND'])
+    assert len(queries) == 2
+
+
+def test_load_fact_chunk_invalidates_cache(engine, queries, monkeypatch):
+    inserted = []
+    monkeypatch.setattr(star_aggregates, 'to_sql_adaptive', lambda df, name, *args, **kwargs: inserted.append(name))
+
+    star_aggregates.query_registrations(engine, ['BRAND'])
+    star_aggregates.load_fact_chunk(engine, pd.DataFrame({'CAR_BRAND_ID': [1]}), {})
+    assert inserted == [star_aggregates.fact_table, star_aggregates.delta_table]
+    assert sum(statement.lstrip().startswith('MERGE') for statement in engine.statements) == len(star_aggregates.rollups)
+
+    star_aggregates.query_registrations(engine, ['BRAND'])
+    assert len(queries) == 2
+
+
+def test_load_fact_chunk_uses_given_connection(engine, monkeypatch):
+    monkeypatch.setattr(star_aggregates, 'to_sql_adaptive', lambda *args, **kwargs: None)
+    statements = []
+    star_aggregates.load_fact_chunk(None, pd.DataFrame(), {}, connection=FakeConnection(statements))
+    assert engine.statements == []
+    assert any(statement.lstrip().startswith('MERGE') for statement in statements)